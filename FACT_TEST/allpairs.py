@@ -0,0 +1,33 @@
+import os, string
+
+# The program run, the files on which its results depend, and the best match
+# of each image as found by it.
+program = '../cbir'
+programs = [program, '../eve.py']
+matches = None
+
+def interface (name, input):
+    '''
+    Interface module between FACT and the all-pairs mode of the cbir program.
+    '''
+    # The first time we are called, run the program once to match every image
+    # against all the others, remembering each one's best match.  Thereafter,
+    # determine which category the program has decided input belongs to by
+    # looking up its best match.  If anything goes wrong, return a failure.
+    global matches
+    try:
+        if matches is None:
+            matches = {}
+            fd = os.popen ('%s --all-pairs *.png' % program)
+            for line in fd:
+                probe, best, score = line.rstrip('\n').split('\t')
+                matches[probe] = best
+            fd.close ()
+        category = matches[input]
+        i = category.find ('-')
+        result = category[0:i]
+        status = True
+    except:
+        result = 'failure'
+        status = False
+    return status, result
@@ -0,0 +1,62 @@
+import os, sys, glob, json
+
+# The test images are those in the current directory, as for the other
+# interfaces; their histograms are found by the first test and kept for the
+# rest, for each combination of settings used.  The results depend on the
+# cbir library as well as on this module.
+here = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (here, '..'))
+programs = [os.path.join (here, '..', 'eve.py')]
+defaults = {'kind': 'flat', 'bins': '64', 'metric': 'correlation'}
+galleries = {}
+
+def interface (name, input, parameters=None):
+    '''
+    Interface module between FACT and the cbir algorithm, run in-process.
+    '''
+    # Find the probe's histogram and compare it with those of the test
+    # images, skipping the probe itself, and determine which category the
+    # best match belongs to.  The settings may be overridden by the
+    # parameters FACT is varying.  If anything goes wrong, return a failure.
+    try:
+        import eve, numpy
+        settings = defaults.copy ()
+        if parameters: settings.update (parameters)
+        kind = settings['kind']
+        bins = int (settings['bins'])
+        metric = settings['metric']
+        key = (kind, bins, metric)
+        if key not in galleries:
+            names = sorted (glob.glob ('*.png'))
+            hists = numpy.array (list (eve.histogram_vectors (names,
+                                                              kind=kind,
+                                                              bins=bins)))
+            galleries[key] = names, eve.histogram_transform (hists, metric)
+        names, hists = galleries[key]
+        probe = eve.histogram_vector_file (input, kind=kind, bins=bins)
+        scores = eve.histogram_similarity (probe, hists, metric,
+                                           transformed=True)
+        scores[[i for i in range (0, len(names)) if names[i] == input]] = \
+            -numpy.inf
+        category = names[int (numpy.argmax (scores))]
+        i = category.find ('-')
+        result = category[0:i]
+        status = True
+    except:
+        result = 'failure'
+        status = False
+    return status, result
+
+# Run as a program, this is a persistent worker for FACT: each test arrives
+# on the standard input as a line of JSON, {"name": ..., "input": ...,
+# "parameters": {...}}, and is answered on the standard output with a line
+# {"status": ..., "result": ...}.
+if __name__ == '__main__':
+    for line in iter (sys.stdin.readline, ''):
+        request = json.loads (line)
+        status, result = interface (str (request['name']),
+                                    str (request['input']),
+                                    request.get ('parameters'))
+        sys.stdout.write (json.dumps ({'status': status, 'result': result})
+                          + '\n')
+        sys.stdout.flush ()
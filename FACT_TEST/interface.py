@@ -1,20 +1,21 @@
 import os, string
 
+# The program run, on which the results depend.
+programs = ['mycbir']
+
 def interface (name, input):
     '''
     Interface module between FACT and the cbir program.
     '''
-    # Run the program, saving the result into tempfile.  Read that file and
-    # from it determine which category the program has decided input belongs to,
-    # then delete tempfile.  If anything goes wrong, return a failure.
-    tempfile = 'RESULT'
-    cmd = './mycbir %s *.png > %s' % (input, tempfile)
+    # Run the program and read its output, from which determine which
+    # category the program has decided input belongs to.  There is no
+    # temporary file, so several tests can be run at once.  If anything goes
+    # wrong, return a failure.
+    cmd = './mycbir %s *.png' % input
     try:
-        os.system (cmd)
-        fd = open (tempfile, 'r')
+        fd = os.popen (cmd)
         category = fd.readline().split()[0]
         fd.close ()
-        os.remove (tempfile)
         i = category.find ('-')
         result = category[0:i]
         status = True
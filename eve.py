@@ -56,6 +56,18 @@ systype = platform.system ()
 tiny = 1.0e-7            # the smallest number worth bothering about
 max_image_value = 255.0  # the largest value normally put into an image
 
+# The ways of comparing histograms known to histogram_similarity().
+histogram_metrics = ['correlation', 'cosine', 'bhattacharyya', 'hellinger',
+                     'chisquare', 'intersection', 'l1', 'l2']
+
+# The times taken by the stages of reading and comparing images, collected
+# only between profile_begin() and profile_end() (see profile_stage()).
+profiling = None
+
+# The file suffixes taken to be images by image_sources().
+image_suffixes = ['.bmp', '.gif', '.jpeg', '.jpg', '.pbm', '.pgm', '.png',
+                  '.ppm', '.tif', '.tiff']
+
 character_height = 13    # height of characters in draw_text()
 character_width = 10     # width of characters in draw_text()
 character_bitmap = {
@@ -497,6 +509,157 @@ def canny (im, lo, hi):
     ce[:,:,0] = canny_edges[:,:] * max_image_value
     return gm, tm, ce
 
+#-------------------------------------------------------------------------------
+def cascade_build (data, kind='flat', bins=64, levels=None, chunk=4096):
+    """
+    Build a cascade for coarse-to-fine searches of a gallery of histogram
+    vectors, such as the data of an index from index_load, returning it as
+    a dictionary.
+
+    The cascade holds a tiny version of each vector, made by merging
+    neighbouring bins with histogram_coarsen.  cascade_search compares a
+    probe with all of them, which is quick, and then compares the full
+    vectors of only those that match best; cascade_recall measures how
+    many of the best matches this misses.  The dictionary contains the
+    coarse vectors ('data'), the type ('kind'), number of bins ('bins') and
+    number of coarse levels ('levels') of the histograms, and the number
+    of vectors ('count').
+
+    Arguments:
+      data  array of histogram vectors, one per row
+      kind  the type of the histograms (see histogram_vector)
+      bins  number of bins in the histograms (default: 64)
+    levels  number of levels per channel in the coarse histograms
+            (default: see histogram_coarsen)
+     chunk  number of rows of data processed at once (default: 4096)
+    """
+    if levels is None: levels = histogram_coarsen_levels (kind, bins)
+    n = len (data)
+    coarse = numpy.zeros ((n, histogram_vector_size (kind, levels)),
+                          dtype=numpy.float32)
+    for lo in xrange (0, n, chunk):
+        coarse[lo:lo+chunk] = histogram_coarsen (data[lo:lo+chunk], kind,
+                                                 bins, levels)
+    return {'data': coarse, 'kind': kind, 'bins': bins, 'levels': levels,
+            'count': n}
+
+#-------------------------------------------------------------------------------
+def cascade_load (name):
+    """
+    Load a cascade saved by cascade_save, raising ValueError if the index
+    from which it was built has changed since.
+
+    Arguments:
+    name  name of the index (see index_build)
+    """
+    manfn, datfn = index_names (name)
+    root, ext = os.path.splitext (manfn)
+    f = open (root + '.cas', 'rb')
+    saved = numpy.load (f)
+    cascade = {}
+    for k in saved.files: cascade[k] = saved[k]
+    f.close ()
+    if str (cascade.get ('fingerprint', '')) != index_fingerprint (name):
+        raise ValueError, 'Cascade is out of date; rebuild it'
+    cascade['fingerprint'] = str (cascade['fingerprint'])
+    cascade['kind'] = str (cascade['kind'])
+    for k in ['bins', 'levels', 'count']: cascade[k] = int (cascade[k])
+    return cascade
+
+#-------------------------------------------------------------------------------
+def cascade_recall (cascade, data, k=10, m=100, metric='correlation',
+                    nqueries=100, seed=0):
+    """
+    Measure how well cascade searches agree with an exhaustive scan,
+    returning the recall at k (the proportion of the k best matches found
+    by the scan that the cascade also finds), and the mean times taken per
+    query by the scan and by the cascade, in seconds.  The queries are
+    vectors picked at random from the gallery itself, each being excluded
+    from its own matches.
+
+    Arguments:
+     cascade  the cascade, from cascade_build or cascade_load
+        data  array of histogram vectors from which cascade was built
+           k  number of best matches compared (default: 10)
+           m  number of coarse matches re-ranked by each search
+              (default: 100)
+      metric  the way histograms are compared (see histogram_similarity)
+    nqueries  number of queries made (default: 100)
+        seed  seed for the random number generator (default: 0)
+    """
+    import time
+    n = len (data)
+    rng = numpy.random.RandomState (seed)
+    queries = rng.choice (n, numpy.clip (nqueries, 1, n), replace=False)
+    found = 0
+    tscan = tcas = 0.0
+    for q in queries:
+        t0 = time.time ()
+        scores = histogram_similarity (data[q], data, metric)
+        scores[q] = -numpy.inf
+        exact = top_matches (scores, k)
+        t1 = time.time ()
+        rows, scores = cascade_search (cascade, data[q], data, k+1, m=m,
+                                       metric=metric)
+        t2 = time.time ()
+        approx = dict.fromkeys (rows[rows != q][:k])
+        found += len ([i for i in exact if i in approx])
+        tscan += t1 - t0
+        tcas += t2 - t1
+    nq = len (queries)
+    return found / (nq * k), tscan / nq, tcas / nq
+
+#-------------------------------------------------------------------------------
+def cascade_save (cascade, name):
+    """
+    Save a cascade alongside the index from which it was built, in a file
+    with the same root and an extension of '.cas', together with the
+    index's fingerprint (see index_fingerprint), so that cascade_load can
+    tell when the index has changed.
+
+    Arguments:
+    cascade  the cascade, from cascade_build
+       name  name of the index (see index_build)
+    """
+    manfn, datfn = index_names (name)
+    root, ext = os.path.splitext (manfn)
+    cascade = cascade.copy ()
+    cascade['fingerprint'] = index_fingerprint (name)
+    f = open (root + '.cas.tmp', 'wb')
+    numpy.savez (f, **cascade)
+    f.close ()
+    os.rename (root + '.cas.tmp', root + '.cas')
+
+#-------------------------------------------------------------------------------
+def cascade_search (cascade, probe, data, k, m=100, metric='correlation'):
+    """
+    Search for the vectors in a gallery that best match a probe using a
+    cascade, returning the row numbers of the (at most) k best, best first,
+    and their similarities to the probe.  The probe's coarse histogram is
+    compared with all those of the cascade, and then the full vectors of
+    the m best of them are compared with the probe.
+
+    Arguments:
+    cascade  the cascade, from cascade_build or cascade_load
+      probe  the vector to be matched
+       data  array of histogram vectors from which cascade was built
+          k  number of matches to be returned
+          m  number of coarse matches that are re-ranked, at least k
+             (default: 100); re-ranking more finds more of the best matches
+             at the cost of speed
+     metric  the way histograms are compared (see histogram_similarity)
+    """
+    if cascade['count'] != len (data):
+        raise ValueError, 'Cascade does not match the data; rebuild it'
+    if m < k: m = k
+    p = histogram_coarsen (probe, cascade['kind'], cascade['bins'],
+                           cascade['levels'])
+    rows = top_matches (histogram_similarity (p, cascade['data'], metric), m)
+    rows.sort ()
+    scores = histogram_similarity (probe, data[rows], metric)
+    best = top_matches (scores, k)
+    return rows[best], scores[best]
+
 #-------------------------------------------------------------------------------
 def centroid (im, c=0):
     """
@@ -701,6 +864,34 @@ def correlation_coefficient (im1, im2):
     v2 = math.sqrt((sumxx-sumx*sumx/n) * (sumyy-sumy*sumy/n))
     return v1 / v2
 
+#-------------------------------------------------------------------------------
+def correlation_scores (probe, gallery, chunk=4096, normalized=False):
+    """
+    Return the absolute correlation coefficient between a probe vector and
+    each row of a gallery of vectors, such as the histogram vectors held in
+    an index.
+
+    Rather than looping over the bins of each pair of vectors, the rows of
+    the gallery are centred and scaled to unit length, after which the
+    correlation coefficients are all obtained from a single matrix-vector
+    product.  This is done 'chunk' rows at a time, so a memory-mapped
+    gallery that is larger than the available memory is streamed through
+    rather than read in all at once.  The values are the same as those
+    calculated by cbir's compare() to within rounding error; a row with no
+    variation (for which the correlation coefficient is undefined) scores
+    zero.  This is the 'correlation' metric of histogram_similarity.
+
+    Arguments:
+         probe  the vector to be compared with each row of the gallery
+       gallery  array of vectors, one per row, of the same length as probe
+         chunk  number of rows of the gallery processed at once
+                (default: 4096)
+    normalized  if True, the rows of the gallery have already been centred
+                and scaled by normalize_histograms (default: False)
+    """
+    return histogram_similarity (probe, gallery, 'correlation', chunk=chunk,
+                                 transformed=normalized)
+
 #-------------------------------------------------------------------------------
 def covariance (im):
     """
@@ -1504,6 +1695,25 @@ def extrema (im):
     """
     return [im.min(), im.max()]
 
+#-------------------------------------------------------------------------------
+def file_hash (fn, blocksize=1048576):
+    """
+    Return the SHA-1 hash of the content of a file as a hexadecimal string.
+
+    Arguments:
+           fn  name of the file whose content is to be hashed
+    blocksize  number of bytes read from the file at a time (default: 1 MB)
+    """
+    import hashlib
+    h = hashlib.sha1 ()
+    f = open (fn, 'rb')
+    while True:
+        block = f.read (blocksize)
+        if not block: break
+        h.update (block)
+    f.close ()
+    return h.hexdigest ()
+
 #-------------------------------------------------------------------------------
 def fill_outline (im, y, x, v=max_image_value, threshold=100):
     """
@@ -1591,6 +1801,60 @@ def find_peaks (im, threshold):
     peaks.sort (reverse=True)
     return peaks
 
+#-------------------------------------------------------------------------------
+def find_roi (im, trim=0.01, margin=0.05, blocks=48):
+    """
+    Find the region of interest in an image of an object against a fairly
+    uniform background, returning its bounding box as [ylo, yhi, xlo, xhi],
+    the upper limits being exclusive so that im[ylo:yhi,xlo:xhi] is the
+    region.
+
+    The image is first reduced to about 'blocks' blocks along its shorter
+    side by averaging, which suppresses the texture of the background.  A
+    plane is fitted to the colours of the blocks around its border to
+    model the background, allowing for uneven lighting, and the distance
+    of each block's colour from it is thresholded using Otsu's method (see
+    find_threshold_otsu).  The box encloses the blocks that stand out,
+    ignoring the extreme 'trim' of them in each direction, and is then
+    widened by 'margin' of the image's size on each side.  If nothing
+    stands out from the background, the box is the whole image.
+
+    Arguments:
+        im  image in which the region of interest is to be found
+      trim  fraction of the outlying blocks ignored at each side
+            (default: 0.01)
+    margin  fraction of the image's size added to each side of the box
+            (default: 0.05)
+    blocks  number of blocks along the shorter side of the image
+            (default: 48)
+    """
+    ny, nx, nc = sizes (im)
+    b = int (numpy.clip (numpy.minimum (ny, nx) // blocks, 1, None))
+    by = ny // b
+    bx = nx // b
+    if by < 2 or bx < 2: return [0, ny, 0, nx]
+    v = numpy.asarray (im[:by*b,:bx*b], dtype=numpy.float32)
+    v = v.reshape (by, b, bx, b, nc).mean (axis=(1, 3))
+    y, x = numpy.mgrid[0:by,0:bx]
+    edge = numpy.zeros ((by, bx), dtype=bool)
+    edge[[0, -1],:] = True
+    edge[:,[0, -1]] = True
+    a = numpy.column_stack ((numpy.ones (edge.sum()), y[edge], x[edge]))
+    c = numpy.linalg.lstsq (a, v[edge], rcond=None)[0]
+    bg = c[0] + y[:,:,numpy.newaxis] * c[1] + x[:,:,numpy.newaxis] * c[2]
+    d = numpy.sqrt (((v - bg)**2).sum (axis=2))
+    if d.max() - d.min() < 1.0: return [0, ny, 0, nx]
+    ys, xs = numpy.nonzero (d > find_threshold_otsu (d))
+    if len (ys) == 0: return [0, ny, 0, nx]
+    ylo, yhi = numpy.percentile (ys, [100.0 * trim, 100.0 * (1.0 - trim)])
+    xlo, xhi = numpy.percentile (xs, [100.0 * trim, 100.0 * (1.0 - trim)])
+    my = margin * ny
+    mx = margin * nx
+    return [int (numpy.clip (ylo * b - my, 0, ny - 1)),
+            int (numpy.clip ((yhi + 1) * b + my, 1, ny)),
+            int (numpy.clip (xlo * b - mx, 0, nx - 1)),
+            int (numpy.clip ((xhi + 1) * b + mx, 1, nx))]
+
 #-------------------------------------------------------------------------------
 def find_skin (im, hlo=300, hhi=30, slo=10, shi=70, vlo=10, vhi=80, ishsv=False):
     """
@@ -2140,6 +2404,417 @@ def histogram (im, bins=64, limits=None, disp=False):
                     style='histogram')
     return a, h
 
+#-------------------------------------------------------------------------------
+def histogram_best_matches (data, metric='correlation', block=1024):
+    """
+    Find the best match of every histogram vector in a gallery among the
+    others, returning the row number of each one's best match (or -1 if
+    there are no others) and the corresponding similarities.
+
+    The full matrix of similarities between all pairs of vectors is
+    calculated 'block' rows at a time with histogram_similarity, so the
+    gallery is transformed only once and the memory used is proportional to
+    block times the number of vectors.
+
+    Arguments:
+      data  array of histogram vectors, one per row
+    metric  the way histograms are compared (see histogram_similarity)
+     block  number of rows of the similarity matrix calculated at once
+            (default: 1024)
+    """
+    n = len (data)
+    g = histogram_transform (data, metric)
+    best = numpy.zeros (n, dtype=int)
+    scores = numpy.zeros (n)
+    for lo in xrange (0, n, block):
+        hi = lo + block
+        sims = histogram_similarity (data[lo:hi], g, metric, transformed=True)
+        rows = numpy.arange (len (sims))
+        sims[rows, rows + lo] = -numpy.inf
+        best[lo:hi] = numpy.argmax (sims, axis=1)
+        scores[lo:hi] = sims[rows, best[lo:hi]]
+    best[scores == -numpy.inf] = -1
+    return best, scores
+
+#-------------------------------------------------------------------------------
+def histogram_bin_numbers (im, kind='flat', bins=64, limits=None):
+    """
+    Return the numbers of the bins of a histogram vector (see
+    histogram_vector) into which the pixels of an image fall, as an array
+    with a plane for each count a pixel contributes: one per channel for
+    'flat' histograms, three for 'rgb' ones and one for joint ones.
+
+    The values of each channel are quantized to an integer bin number, and
+    for joint histograms the bin numbers of the channels are combined into
+    a single one.  For 'flat' histograms, the bins are the same as those
+    of histogram(), and values outside the limits are given the number one
+    beyond the last bin so that they can be discarded.
+
+    Arguments:
+        im  image whose pixels' bin numbers are to be found
+      kind  the type of histogram (see histogram_vector)
+      bins  number of bins in the histogram, or in each channel of a
+            joint one (default: 64)
+    limits  extrema between which a 'flat' histogram is found
+            (default: 0 and max_image_value)
+    """
+    if kind == 'flat':
+        if limits is None: limits = [0, max_image_value]
+        edges = numpy.linspace (limits[0], limits[1], bins+1)
+        q = numpy.searchsorted (edges, im, side='right') - 1
+        q[im == edges[-1]] = bins - 1
+        q[(q < 0) | (q >= bins)] = bins
+        return q.astype (numpy.uint32)
+    if kind not in ['rgb', 'joint', 'hsv']:
+        raise ValueError, 'Unknown histogram kind "%s"' % kind
+
+    # Quantize the values of each channel into 'bins' levels.
+    ny, nx, nc = sizes (im)
+    if nc < 3: im = im[:,:,[0,0,0]]
+    else: im = im[:,:,0:3]
+    if kind == 'hsv':
+        hsv = numpy.array (im, dtype=numpy.float32)
+        rgb_to_hsv (hsv)
+        hsv *= numpy.array ([bins / 360.0, bins / 100.0, bins / 100.0])
+        q = numpy.clip (hsv, 0, bins-1).astype (numpy.uint32)
+    else:
+        if im.dtype != numpy.uint8: im = numpy.clip (im, 0, max_image_value)
+        q = (im.astype (numpy.uint32) * bins) >> 8
+
+    # Combine the levels into bin numbers.
+    if kind == 'rgb':
+        return q + numpy.array ([0, bins, 2*bins], dtype=numpy.uint32)
+    q = (q[:,:,0] * bins + q[:,:,1]) * bins + q[:,:,2]
+    return q[:,:,numpy.newaxis]
+
+#-------------------------------------------------------------------------------
+def histogram_coarsen (h, kind, bins, levels):
+    """
+    Merge neighbouring bins of a histogram vector, or of each of an array
+    of them, to give coarser ones with 'levels' levels per channel instead
+    of 'bins', returning the result.
+    The coarse version of a 'joint' or 'hsv' histogram vector is the same
+    as would have been found with 'levels' bins in the first place.
+
+    Arguments:
+         h  a histogram vector, or an array of them, one per row
+      kind  the type of the histograms (see histogram_vector)
+      bins  number of bins in the histograms
+    levels  number of levels per channel in the result, which must divide
+            bins exactly (histogram_coarsen_levels gives a sensible choice)
+    """
+    if bins % levels != 0:
+        raise ValueError, 'Coarse levels %d do not divide %d bins' % \
+            (levels, bins)
+    f = bins // levels
+    single = numpy.ndim (h) == 1
+    h = numpy.array (h, dtype=numpy.float32, ndmin=2)
+    n = len (h)
+    if kind == 'flat':
+        c = h.reshape (n, levels, f).sum (axis=2)
+    elif kind == 'rgb':
+        c = h.reshape (n, 3, levels, f).sum (axis=3)
+    else:
+        c = h.reshape (n, levels, f, levels, f, levels, f).sum (axis=(2,4,6))
+    c = c.reshape (n, histogram_vector_size (kind, levels))
+    if single: return c[0]
+    return c
+
+#-------------------------------------------------------------------------------
+def histogram_coarsen_levels (kind, bins):
+    """
+    Return a sensible number of levels per channel for coarse histograms
+    (see histogram_coarsen): up to 16 for 'flat' and 'rgb' histograms and
+    up to 4 for joint ones, so that the coarse vectors have no more than 64
+    elements.
+
+    Arguments:
+    kind  the type of the histograms (see histogram_vector)
+    bins  number of bins in the histograms
+    """
+    import fractions
+    if kind in ['flat', 'rgb']: return fractions.gcd (bins, 16)
+    return fractions.gcd (bins, 4)
+
+#-------------------------------------------------------------------------------
+def histogram_drift (fn, inc=4, kind='flat', bins=64):
+    """
+    Measure how much the histogram vector of an image changes when it is
+    found from a sub-sampled version of the image read by image_subsampled
+    rather than from the full image, returning the correlation coefficient
+    between the two vectors and the sum of the absolute differences
+    between them after each has been normalized to sum to unity (which lies
+    between 0, for identical distributions, and 2).
+
+    Arguments:
+      fn  name of the file containing the image
+     inc  the sub-sampling factor (default: 4)
+    kind  the type of histogram to be found (see histogram_vector)
+    bins  number of bins in the histogram (default: 64)
+    """
+    h1 = histogram_vector_file (fn, kind=kind, bins=bins)
+    h2 = histogram_vector_file (fn, kind=kind, bins=bins, inc=inc)
+    r = numpy.dot (normalize_histograms (h1)[0], normalize_histograms (h2)[0])
+    d = numpy.abs (h1 / h1.sum() - h2 / h2.sum()).sum()
+    return r, d
+
+#-------------------------------------------------------------------------------
+def histogram_similarity (probes, gallery, metric='correlation', chunk=4096,
+                          transformed=False):
+    """
+    Compare one or more probe histogram vectors with each row of a gallery
+    of them, returning the similarities: a vector if there is one probe,
+    else an array with a row per probe and a column per gallery vector.
+    Larger values always mean more similar, so distances are negated.
+
+    The histograms are first transformed (see histogram_transform) so that
+    'correlation', 'cosine', 'bhattacharyya' and 'hellinger' similarities,
+    and 'l2' distances, all come from a single matrix product of the probes
+    with the gallery; the remaining metrics are calculated for all gallery
+    vectors at once, one probe at a time.  The gallery is processed 'chunk'
+    rows at a time, so a memory-mapped gallery larger than the available
+    memory is streamed through.
+
+    Arguments:
+         probes  a histogram vector, or an array of them, one per row
+        gallery  array of histogram vectors, one per row
+         metric  the way histograms are compared, one of:
+                   'correlation'    absolute correlation coefficient
+                   'cosine'         cosine of the angle between them
+                   'bhattacharyya'  Bhattacharyya coefficient
+                   'hellinger'      Hellinger distance
+                   'chisquare'      chi-square distance
+                   'intersection'   histogram intersection
+                   'l1'             L1 (city-block) distance
+                   'l2'             L2 (Euclidean) distance
+                 or a function which is given the transformed probes and
+                 a chunk of the gallery and returns their similarities
+                 (default: 'correlation')
+          chunk  number of rows of the gallery processed at once
+                 (default: 4096)
+    transformed  if True, the gallery has already been transformed by
+                 histogram_transform for this metric (default: False)
+    """
+    single = numpy.ndim (probes) == 1
+    p = histogram_transform (probes, metric)
+    n = len (gallery)
+    sims = numpy.zeros ((len (p), n))
+    for lo in xrange (0, n, chunk):
+        g = gallery[lo:lo+chunk]
+        if not transformed: g = histogram_transform (g, metric)
+        if callable (metric):
+            s = metric (p, g)
+        elif metric in ['correlation', 'cosine', 'bhattacharyya',
+                        'hellinger', 'l2']:
+            s = numpy.dot (p, g.T)
+            if metric == 'correlation':
+                s = numpy.abs (s)
+            elif metric == 'hellinger':
+                s = -numpy.sqrt (numpy.clip (1.0 - s, 0.0, None))
+            elif metric == 'l2':
+                s = (p * p).sum (axis=1)[:,numpy.newaxis] - 2.0 * s \
+                    + (g * g).sum (axis=1)[numpy.newaxis,:]
+                s = -numpy.sqrt (numpy.clip (s, 0.0, None))
+        else:
+            s = numpy.zeros ((len (p), len (g)))
+            for i in xrange (0, len (p)):
+                if metric == 'intersection':
+                    s[i] = numpy.minimum (g, p[i]).sum (axis=1)
+                elif metric == 'l1':
+                    s[i] = -numpy.abs (g - p[i]).sum (axis=1)
+                elif metric == 'chisquare':
+                    num = (g - p[i])**2
+                    den = g + p[i]
+                    den[den <= 0.0] = 1.0
+                    s[i] = -(num / den).sum (axis=1)
+        sims[:,lo:lo+chunk] = s
+    if single: return sims[0]
+    return sims
+
+#-------------------------------------------------------------------------------
+def histogram_transform (h, metric='correlation'):
+    """
+    Transform histogram vectors into the form in which histogram_similarity
+    compares them with a metric, returning a float64 array with one vector
+    per row.  For 'correlation', the vectors are centred and scaled to unit
+    length (see normalize_histograms); for 'cosine', they are scaled to
+    unit length; for 'bhattacharyya' and 'hellinger', they are scaled to
+    sum to unity and their square roots taken; and for the other metrics,
+    they are scaled to sum to unity.
+
+    Arguments:
+         h  a single histogram vector or an array of them, one per row
+    metric  the metric for which they are to be transformed (see
+            histogram_similarity)
+    """
+    if metric == 'correlation': return normalize_histograms (h)
+    h = numpy.array (h, dtype=numpy.float64, ndmin=2)
+    if callable (metric): return h
+    if metric not in histogram_metrics:
+        raise ValueError, 'Unknown histogram metric "%s"' % metric
+    if metric == 'cosine': norms = numpy.sqrt ((h * h).sum (axis=1))
+    else: norms = h.sum (axis=1)
+    norms[norms <= 0.0] = 1.0
+    h /= norms[:,numpy.newaxis]
+    if metric in ['bhattacharyya', 'hellinger']: h = numpy.sqrt (h)
+    return h
+
+#-------------------------------------------------------------------------------
+def histogram_vector (im, kind='flat', bins=64):
+    """
+    Return a histogram of an image as a float32 feature vector, suitable
+    for storing in an index (see index_build) and for image retrieval.
+
+    Apart from 'flat' ones, the histograms are found in a single pass over
+    the image: the value of each pixel is quantized to an integer bin
+    number in each channel, the bin numbers are combined into a single
+    index, and the indices are counted with numpy.bincount.  This is much
+    quicker than finding a histogram of each channel separately, especially
+    for images of type numpy.uint8 (see histogram_vector_file).
+    Monochrome images are treated as having equal red, green and blue
+    values.
+
+    Arguments:
+      im  image for which the histogram vector is to be found
+    kind  the type of histogram to be found, one of:
+            'flat'  the values of all channels are binned together,
+                    as histogram() does (bins bins)
+             'rgb'  separate histograms of the red, green and blue
+                    channels, one after the other (3 * bins bins)
+           'joint'  a joint histogram of the red, green and blue values,
+                    each quantized into 'bins' levels (bins**3 bins)
+             'hsv'  a joint histogram of the hue, saturation and value
+                    (see rgb_to_hsv), each quantized into 'bins' levels
+                    (bins**3 bins)
+    bins  number of bins in the histogram, or in each channel of a joint
+          one (default: 64; 8 or 16 are sensible for joint histograms)
+    """
+    if kind == 'flat':
+        a, h = histogram (im, bins=bins, limits=[0, max_image_value])
+        return numpy.asarray (h, dtype=numpy.float32)
+    q = histogram_bin_numbers (im, kind=kind, bins=bins)
+    h = numpy.bincount (q.ravel(), minlength=histogram_vector_size (kind, bins))
+    return numpy.asarray (h, dtype=numpy.float32)
+
+#-------------------------------------------------------------------------------
+def histogram_vector_file (fn, kind='flat', bins=64, inc=1, roi=None):
+    """
+    Read an image from a file and return its histogram vector.  When a
+    region of interest is given or to be found, only the pixels within it
+    contribute to the histogram, and both the vector and the bounding box
+    of the region are returned.
+
+    Arguments:
+      fn  name of the file (or a file object) containing the image
+    kind  the type of histogram to be found (see histogram_vector)
+    bins  number of bins in the histogram (default: 64)
+     inc  if greater than 1, the image is read sub-sampled by this factor
+          by image_subsampled (default: 1)
+     roi  None to use the whole image (the default), True to find the
+          region of interest with find_roi, or its bounding box
+          [ylo, yhi, xlo, xhi] in the image as read
+
+    Histograms other than 'flat' ones are found directly from the 8-bit
+    values read from the file, without converting them to the usual EVE
+    image type.
+    """
+    if profiling is not None: profile_image (fn)
+    if kind == 'flat': type = numpy.float32
+    else: type = numpy.uint8
+    if inc > 1: im = image_subsampled (fn, inc=inc, type=type)
+    else: im = image (fn, type=type)
+    if profiling is not None: mark = profile_mark ()
+    if roi is True:
+        roi = find_roi (im)
+        if profiling is not None: mark = profile_stage ('roi', mark)
+    if roi is not None:
+        ylo, yhi, xlo, xhi = roi
+        im = im[ylo:yhi,xlo:xhi]
+    v = histogram_vector (im, kind=kind, bins=bins)
+    if profiling is not None: profile_stage ('histogram', mark)
+    if roi is None: return v
+    return v, list (roi)
+
+#-------------------------------------------------------------------------------
+def histogram_vector_size (kind='flat', bins=64):
+    """
+    Return the length of the histogram vectors found by histogram_vector.
+
+    Arguments:
+    kind  the type of histogram (see histogram_vector)
+    bins  number of bins in the histogram (default: 64)
+    """
+    if kind == 'flat': return bins
+    if kind == 'rgb': return 3 * bins
+    return bins**3
+
+#-------------------------------------------------------------------------------
+def histogram_vectors (fns, kind='flat', bins=64, inc=1, jobs=1, window=None,
+                       roi=None, pool=None):
+    """
+    Generate the histogram vectors of a series of image files, in order.
+    Each may be given by name or as a file object such as the sources
+    generated by image_sources.
+
+    When jobs is greater than one, the files are read and their histograms
+    found by a pool of that many worker processes, which lets several cores
+    share the work of decoding the images.  At most 'window' files are in
+    progress at any time, so memory use stays bounded however many files
+    there are, and each vector is yielded as soon as it and all those before
+    it are ready.  The vectors are exactly those that histogram_vector_file
+    would give; when regions of interest are used, (vector, box) pairs are
+    generated as it returns them.  When profiling, the times of the stages
+    carried out by the workers are passed back and recorded too.
+
+    Arguments:
+        fns  iterable of the names of the image files (or file objects)
+       kind  the type of histogram to be found (see histogram_vector)
+       bins  number of bins in the histogram (default: 64)
+        inc  sub-sampling factor (default: 1; see histogram_vector_file)
+       jobs  number of worker processes to use (default: 1, no workers)
+     window  maximum number of files in progress at once
+             (default: four times the number of jobs)
+        roi  None to use the whole of each image (the default), True to
+             find the region of interest in each, or a list with an entry
+             for each file that is either True or a bounding box (see
+             histogram_vector_file)
+       pool  a multiprocessing pool of jobs workers to use rather than
+             starting a new one, as when the vectors of many short series
+             of files are wanted; it is left running (default: none)
+    """
+    if isinstance (roi, list): rois = roi
+    else: rois = None
+    if jobs <= 1 and pool is None:
+        for i, fn in enumerate (fns):
+            if rois is not None: roi = rois[i]
+            yield histogram_vector_file (fn, kind=kind, bins=bins, inc=inc,
+                                         roi=roi)
+        return
+    import collections, multiprocessing
+    if window is None: window = 4 * jobs
+    own = pool is None
+    if own: pool = multiprocessing.Pool (jobs)
+    pending = collections.deque ()
+    try:
+        for i, fn in enumerate (fns):
+            if rois is not None: roi = rois[i]
+            args = (fn, kind, bins, inc, roi)
+            if profiling is None:
+                pending.append (pool.apply_async (histogram_vector_file, args))
+            else:
+                pending.append (pool.apply_async (profile_call,
+                                                  (histogram_vector_file,
+                                                   args)))
+            if len (pending) >= window:
+                yield profile_result (pending.popleft().get ())
+        while len (pending) > 0:
+            yield profile_result (pending.popleft().get ())
+        if own: pool.close ()
+    except:
+        if own: pool.terminate ()
+        raise
+    if own: pool.join ()
+
 #-------------------------------------------------------------------------------
 def hough_line (im, nr=512, na=512, yc=None, xc=None, threshold=10,\
                 disp=False, dispacc=False):
@@ -2241,13 +2916,18 @@ def image (fromwhat, type=numpy.float32):
     Arguments:
     fromwhat  the source from which the image is to be created, one of:
                      a string:  the name of a file to be read in
+                a file object:  an open file (or file-like object such as
+                                a StringIO) from which the image is read
                 a numpy array:  the new image is a copy of this image
               a list or tuple:  the dimensions (ny, nx, nc)
         type  the type of the image to be ceated (default: numpy.float32)
     """
-    if isinstance (fromwhat, str):
+    if isinstance (fromwhat, str) or hasattr (fromwhat, 'read'):
         import Image
+        if profiling is not None: mark = profile_mark ()
         pic = Image.open (fromwhat)
+        pic.load ()
+        if profiling is not None: mark = profile_stage ('decode', mark)
         # Something seems to be broken with at least 16-bit TIFFs...
         if pic.mode == "I;16":
             temp = numpy.fromstring(pic.tostring(), dtype=numpy.uint16)
@@ -2258,6 +2938,7 @@ def image (fromwhat, type=numpy.float32):
             nc = len (pic.getbands ())
             nx, ny = pic.size
             im.shape = [ny, nx, nc]
+        if profiling is not None: profile_stage ('convert', mark)
     elif isinstance (fromwhat, numpy.ndarray):
         ny, nx, nc = fromwhat.shape
         im = numpy.zeros ((ny, nx, nc))
@@ -2267,6 +2948,417 @@ def image (fromwhat, type=numpy.float32):
         raise ValueError, 'Illegal argument type'
     return im
 
+#-------------------------------------------------------------------------------
+def image_sources (paths):
+    """
+    Generate the names of a series of images and the sources from which
+    they can be read, in turn, as (name, source) pairs.  Each source is
+    either the name of a file or a file object holding the image's
+    contents, and can be given to image, image_subsampled or
+    histogram_vectors.
+
+    Each path may be an image file, which is used as it is; a directory,
+    which is walked recursively in sorted order; or a tar (possibly
+    compressed) or zip archive.  Only files whose suffixes are among
+    image_suffixes are taken from directories and archives.  Archive members
+    are read straight into memory one at a time, a tar archive being read
+    as a stream, so that a gallery need not be extracted and only a single
+    member is held in memory at a time.  The name of a file found in a
+    directory or archive is its path below it joined to the path given.
+
+    Arguments:
+    paths  iterable of the names of files, directories and archives
+    """
+    import StringIO, tarfile, zipfile
+    for path in paths:
+        if os.path.isdir (path):
+            for dir, subdirs, files in os.walk (path):
+                subdirs.sort ()
+                for f in sorted (files):
+                    if os.path.splitext (f)[1].lower() in image_suffixes:
+                        fn = os.path.join (dir, f)
+                        yield fn, fn
+        elif os.path.splitext (path)[1].lower() in image_suffixes:
+            yield path, path
+        elif zipfile.is_zipfile (path):
+            z = zipfile.ZipFile (path, 'r')
+            for info in z.infolist ():
+                if os.path.splitext (info.filename)[1].lower() \
+                       in image_suffixes:
+                    yield os.path.join (path, info.filename), \
+                        StringIO.StringIO (z.read (info.filename))
+            z.close ()
+        elif os.path.isfile (path) and tarfile.is_tarfile (path):
+            t = tarfile.open (path, 'r|*')
+            for member in t:
+                if member.isfile () and \
+                       os.path.splitext (member.name)[1].lower() \
+                       in image_suffixes:
+                    f = t.extractfile (member)
+                    yield os.path.join (path, member.name), \
+                        StringIO.StringIO (f.read ())
+            t.close ()
+        else:
+            yield path, path
+
+#-------------------------------------------------------------------------------
+def image_subsampled (fn, inc=4, type=numpy.float32):
+    """
+    Read an image from a file at reduced resolution, for when only global
+    statistics such as its histogram are needed.
+
+    The result is much as subsample() would give from the full image, but
+    it is obtained more cheaply.  JPEG images are decoded directly at a
+    reduced scale (a half, a quarter or an eighth, whichever is the largest
+    that divides inc) using PIL's draft mode, which avoids most of the work
+    of decoding them; and only the pixels of what remains that are inc
+    pixels apart in the full image are converted to the EVE image type, so
+    that the image is sub-sampled by exactly inc.  Other formats must still be decoded in full but avoid the
+    conversion.  histogram_drift measures how much a histogram changes as a
+    result.
+
+    Arguments:
+      fn  name of the file (or a file object) containing the image
+     inc  the sub-sampling factor (default: 4)
+    type  the type of the image to be created (default: numpy.float32)
+    """
+    import Image
+    pic = Image.open (fn)
+    if pic.mode == "I;16": return subsample (image (fn, type=type), inc)
+    if profiling is not None: mark = profile_mark ()
+    nx, ny = pic.size
+    scale = 8
+    while inc % scale != 0: scale //= 2
+    pic.draft (pic.mode, (nx // scale, ny // scale))
+    pic.load ()
+    if profiling is not None: mark = profile_stage ('decode', mark)
+    # A JPEG decoded at a scale of 1/s is ceil(nx/s) pixels wide; the scale
+    # PIL chose is at most the one asked for, so it too divides inc.
+    while scale > 1 and (pic.size[0] != -(-nx // scale) or
+                         pic.size[1] != -(-ny // scale)):
+        scale //= 2
+    step = inc // scale
+    pixels = numpy.asarray (pic)
+    if pixels.ndim < 3: pixels = pixels[:,:,numpy.newaxis]
+    im = numpy.array (pixels[::step,::step], dtype=type)
+    if profiling is not None: profile_stage ('convert', mark)
+    return im
+
+#-------------------------------------------------------------------------------
+def index_build (fns, name, kind='flat', bins=64, inc=1, jobs=1, roi=False):
+    """
+    Build an index of the histogram vectors of a set of images, returning
+    the number of images indexed.
+
+    The index comprises two files.  The first, whose name is 'name' (with
+    an extension of '.idx' appended if there isn't one), is a text manifest
+    that records the type of histogram, the sub-sampling factor with which
+    the images were read and, for each image, the SHA-1 hash, size and
+    modification time of its file followed by its name and, if histograms
+    are restricted to regions of interest, the bounding box of its region
+    as found by find_roi, so that it need never be found again.  The
+    second, with the same root but an extension of '.dat', holds one
+    float32 histogram vector per image, one after the other, in the same
+    order as the manifest, followed by the hexadecimal SHA-1 hash of the
+    vectors; index_load memory-maps it.  Both files are written under
+    temporary names and renamed into place, the manifest last, so an
+    existing index is never left half-written; as the manifest records the
+    hash too, index_load can tell if it is read between the two renames.
+
+    Arguments:
+     fns  list of the names of the image files to be indexed
+    name  name of the index
+    kind  the type of histogram to be stored (see histogram_vector)
+    bins  number of bins in the histogram (default: 64)
+     inc  sub-sampling factor with which the images are read
+          (default: 1; see histogram_vector_file)
+    jobs  number of worker processes used to find the histograms
+          (default: 1; see histogram_vectors)
+     roi  if True, each histogram is restricted to the image's region of
+          interest (default: False)
+    """
+    import hashlib
+    manfn, datfn = index_names (name)
+    entries = []
+    dims = histogram_vector_size (kind, bins)
+    df = open (datfn + '.tmp', 'wb')
+    h = hashlib.sha1 ()
+    vectors = histogram_vectors (fns, kind=kind, bins=bins, inc=inc,
+                                 jobs=jobs, roi=roi or None)
+    for i, v in enumerate (vectors):
+        fn = fns[i]
+        st = os.stat (fn)
+        entries.append ([file_hash (fn), st.st_size, st.st_mtime, fn])
+        if roi:
+            v, box = v
+            entries[-1].append (box)
+        b = numpy.asarray (v, dtype=numpy.float32).tostring ()
+        h.update (b)
+        df.write (b)
+    df.write (h.hexdigest ())
+    df.close ()
+    index_write_manifest (manfn, datfn, kind, bins, inc, dims, entries, roi,
+                          h.hexdigest ())
+    os.rename (datfn + '.tmp', datfn)
+    os.rename (manfn + '.tmp', manfn)
+    return len (entries)
+
+#-------------------------------------------------------------------------------
+def index_fingerprint (name):
+    """
+    Return a string that identifies the contents of an index, changing
+    whenever any of its vectors do, so that the structures built from it
+    (see ivf_save and cascade_save) can tell when they are out of date.
+    This is the hash of the vectors that the manifest records or, for an
+    index that does not record it, a hash of the manifest's settings and
+    the hashes and names of its images.
+
+    Arguments:
+    name  name of the index
+    """
+    import hashlib
+    manfn, datfn = index_names (name)
+    h = hashlib.sha1 ()
+    f = open (manfn, 'r')
+    for line in f:
+        words = line.split ()
+        if len (words) == 0 or words[0][0] == '#': continue
+        if words[0] == 'datahash':
+            f.close ()
+            return words[1]
+        if words[0] == 'image': words = words[:2] + words[4:]
+        h.update (' '.join (words) + '\n')
+    f.close ()
+    return h.hexdigest ()
+
+#-------------------------------------------------------------------------------
+def index_load (name):
+    """
+    Load an index built by index_build, returning a dictionary.
+
+    The dictionary contains the type ('kind') and number of bins ('bins')
+    of the histograms, the sub-sampling factor ('inc'), the length of each
+    vector ('dims'), whether they are restricted to regions of interest
+    ('roi'), lists of the image file names ('names'), hashes ('hashes'),
+    sizes ('sizes'), modification times ('mtimes') and, with 'roi', the
+    bounding boxes of their regions ('boxes'), the hash of the vectors
+    ('datahash', None for an index that does not record it), and the
+    vectors themselves
+    ('data') as a read-only, memory-mapped numpy array with one row per
+    image.  Only the parts of 'data' that are actually used are read from
+    disk.  If the data file does not end with the hash of its vectors that
+    the manifest records, as when the index is being rewritten, ValueError
+    is raised.
+
+    Arguments:
+    name  name of the index
+    """
+    manfn, datfn = index_names (name)
+    idx = {'names': [], 'hashes': [], 'sizes': [], 'mtimes': [], 'inc': 1,
+           'roi': False, 'boxes': [], 'datahash': None}
+    f = open (manfn, 'r')
+    for line in f:
+        words = line.split (None, 1)
+        if len (words) == 0 or words[0][0] == '#': continue
+        verb = words[0]
+        rest = words[1].rstrip ('\n')
+        if verb == 'feature':
+            kind, bins = rest.split ()
+            idx['kind'] = kind
+            idx['bins'] = int (bins)
+        elif verb == 'subsample':
+            idx['inc'] = int (rest)
+        elif verb == 'dims':
+            idx['dims'] = int (rest)
+        elif verb == 'roi':
+            idx['roi'] = True
+        elif verb == 'datahash':
+            idx['datahash'] = rest
+        elif verb == 'box':
+            idx['boxes'].append ([int (w) for w in rest.split ()])
+        elif verb == 'image':
+            h, size, mtime, fn = rest.split (None, 3)
+            idx['hashes'].append (h)
+            idx['sizes'].append (int (size))
+            idx['mtimes'].append (float (mtime))
+            idx['names'].append (fn)
+    f.close ()
+    n = len (idx['names'])
+    if idx['datahash'] is not None:
+        size = n * idx['dims'] * 4
+        f = open (datfn, 'rb')
+        f.seek (0, 2)
+        end = f.tell ()
+        f.seek (size)
+        trailer = f.read ()
+        f.close ()
+        if end != size + len (idx['datahash']) or trailer != idx['datahash']:
+            raise ValueError, 'Index data file does not match its manifest'
+    if n == 0:
+        idx['data'] = numpy.zeros ((0, idx['dims']), dtype=numpy.float32)
+    else:
+        idx['data'] = numpy.memmap (datfn, dtype=numpy.float32, mode='r',
+                                    shape=(n, idx['dims']))
+    return idx
+
+#-------------------------------------------------------------------------------
+def index_names (name):
+    """
+    Return the names of the manifest and data files of an index.  The
+    manifest is given an extension of '.idx' if the name has none, or if
+    it is that of the data file.
+
+    Arguments:
+    name  name of the index
+    """
+    root, ext = os.path.splitext (name)
+    if ext == '' or ext == '.dat': ext = '.idx'
+    return root + ext, root + '.dat'
+
+#-------------------------------------------------------------------------------
+def index_update (fns, name, kind='flat', bins=64, inc=1, jobs=1, roi=False):
+    """
+    Bring an index up to date with a set of images, returning the numbers
+    of images that were added, removed, changed and left unchanged.
+
+    An image whose file has the same size and modification time as when it
+    was indexed is assumed not to have changed.  When only the
+    modification time differs, the file's content hash is compared with the
+    one in the index to decide; and when an image is new to the index but
+    its hash matches an existing entry (e.g., because the file was
+    renamed), that entry's vector is re-used.  Histograms are found only
+    for the remaining images, and the updated index is written under
+    temporary names and renamed into place, as in index_build.  If the
+    index holds a different kind of histogram, every histogram is found
+    afresh, though the regions of interest of unchanged images are re-used
+    if they were read in the same way; and if the index does not exist or
+    there is nothing to re-use, it is simply built afresh.
+
+    Arguments:
+     fns  list of the names of the image files that are to be indexed
+    name  name of the index
+    kind  the type of histogram to be stored (see histogram_vector)
+    bins  number of bins in the histogram (default: 64)
+     inc  sub-sampling factor with which the images are read
+          (default: 1; see histogram_vector_file)
+    jobs  number of worker processes used to find the histograms
+          (default: 1; see histogram_vectors)
+     roi  if True, each histogram is restricted to the image's region of
+          interest (default: False)
+    """
+    manfn, datfn = index_names (name)
+    if not os.path.exists (manfn):
+        n = index_build (fns, name, kind=kind, bins=bins, inc=inc, jobs=jobs,
+                         roi=roi)
+        return n, 0, 0, 0
+    old = index_load (name)
+    same_boxes = roi and old['roi'] and old['inc'] == inc
+    same_vectors = old['kind'] == kind and old['bins'] == bins and \
+                   old['inc'] == inc and old['roi'] == roi
+    if not same_vectors and not same_boxes:
+        n = index_build (fns, name, kind=kind, bins=bins, inc=inc, jobs=jobs,
+                         roi=roi)
+        return n, len (old['names']), 0, 0
+
+    # Work out which of the images are unchanged, and where their vectors
+    # are in the existing index.
+    byname = {}
+    byhash = {}
+    for i in xrange (0, len (old['names'])):
+        byname[old['names'][i]] = i
+        byhash[old['hashes'][i]] = i
+    rows = []
+    entries = []
+    todo = []
+    todo_rois = []
+    added = changed = 0
+    for fn in fns:
+        st = os.stat (fn)
+        i = byname.get (fn)
+        if i is not None and old['sizes'][i] == st.st_size and \
+               old['mtimes'][i] == st.st_mtime:
+            h = old['hashes'][i]
+        else:
+            h = file_hash (fn)
+            if i is None: added += 1
+            elif old['hashes'][i] != h: changed += 1
+            if i is None or old['hashes'][i] != h: i = byhash.get (h)
+        if i is None or not same_vectors:
+            todo.append (fn)
+            if i is not None and same_boxes:
+                todo_rois.append (old['boxes'][i])
+            else:
+                todo_rois.append (True)
+            i = None
+        rows.append (i)
+        entries.append ([h, st.st_size, st.st_mtime, fn])
+    present = dict.fromkeys (fns)
+    removed = len ([fn for fn in old['names'] if fn not in present])
+
+    # Write out the new data file, copying the vectors (and regions) of
+    # unchanged images and finding the histograms of the rest.
+    if not roi: todo_rois = None
+    vectors = histogram_vectors (todo, kind=kind, bins=bins, inc=inc,
+                                 jobs=jobs, roi=todo_rois)
+    import hashlib
+    dims = histogram_vector_size (kind, bins)
+    df = open (datfn + '.tmp', 'wb')
+    h = hashlib.sha1 ()
+    for j, i in enumerate (rows):
+        if i is None:
+            v = vectors.next ()
+            if roi: v, box = v
+        else:
+            v = old['data'][i]
+            if roi: box = old['boxes'][i]
+        if roi: entries[j].append (box)
+        b = numpy.asarray (v, dtype=numpy.float32).tostring ()
+        h.update (b)
+        df.write (b)
+    df.write (h.hexdigest ())
+    df.close ()
+    index_write_manifest (manfn, datfn, kind, bins, inc, dims, entries, roi,
+                          h.hexdigest ())
+    del old
+    os.rename (datfn + '.tmp', datfn)
+    os.rename (manfn + '.tmp', manfn)
+    return added, removed, changed, len (fns) - added - changed
+
+#-------------------------------------------------------------------------------
+def index_write_manifest (manfn, datfn, kind, bins, inc, dims, entries,
+                          roi=False, datahash=None):
+    """
+    Write the manifest of an index to a temporary file alongside manfn,
+    which the caller renames into place.
+
+    Arguments:
+      manfn  name of the manifest file
+      datfn  name of the data file that the manifest describes
+       kind  the type of histogram stored in the index
+       bins  number of bins in the histogram
+        inc  sub-sampling factor with which the images were read
+       dims  length of each histogram vector
+    entries  list of [hash, size, mtime, filename] for each image, followed
+             by the bounding box of its region of interest if roi is True
+        roi  whether the histograms are restricted to regions of interest
+             (default: False)
+   datahash  the SHA-1 hash of the vectors in the data file, with which it
+             ends (default: none)
+    """
+    f = open (manfn + '.tmp', 'w')
+    print >>f, '# EVE histogram index'
+    print >>f, 'feature', kind, bins
+    print >>f, 'subsample', inc
+    print >>f, 'dims', dims
+    if roi: print >>f, 'roi', 'detect'
+    print >>f, 'count', len (entries)
+    print >>f, 'data', os.path.basename (datfn)
+    if datahash is not None: print >>f, 'datahash', datahash
+    for e in entries:
+        print >>f, 'image', e[0], e[1], repr (e[2]), e[3]
+        if roi: print >>f, 'box', e[4][0], e[4][1], e[4][2], e[4][3]
+    f.close ()
+
 #-------------------------------------------------------------------------------
 def insert (im, reg, yc, xc, operation='='):
     """
@@ -2293,6 +3385,269 @@ def insert (im, reg, yc, xc, operation='='):
     elif operation == '/': im[ylo:yhi,xlo:xhi,:] /= reg
     else: raise ValueError, 'Invalid operation type'
 
+#-------------------------------------------------------------------------------
+def integral_histogram (im, kind='flat', bins=64, limits=None, step=1):
+    """
+    Build the integral histogram of an image, returning it as a dictionary,
+    so that the histogram of any rectangular region of the image can then
+    be found by integral_histogram_region in time proportional to the
+    number of bins, however large the region.
+
+    The integral histogram holds, for each bin, the number of pixels above
+    and to the left of every position that fall into it: the cumulative sum
+    of the pixels' counts over rows and columns.  It is held in the
+    smallest unsigned integer type that can hold the total count.  Its size
+    is the number of bins times the number of positions, so when memory is
+    tight, fewer bins can be used or 'step' can be increased: the counts
+    are then held only every 'step' rows and columns, so that the size
+    falls by a factor of step squared, and regions are enlarged to the
+    nearest multiples of step.  The dictionary contains the cumulative
+    counts ('data', with a leading row and column of zeros), the type
+    ('kind'), number of bins ('bins') and limits ('limits') of the
+    histogram, the step ('step') and the size of the image ('ny', 'nx').
+
+    Arguments:
+        im  image whose integral histogram is to be found
+      kind  the type of histogram (see histogram_vector)
+      bins  number of bins in the histogram, or in each channel of a joint
+            one (default: 64)
+    limits  extrema between which a 'flat' histogram is found
+            (default: 0 and max_image_value)
+      step  spacing of the rows and columns at which the counts are held
+            (default: 1)
+    """
+    ny, nx, nc = sizes (im)
+    q = histogram_bin_numbers (im, kind=kind, bins=bins, limits=limits)
+    nb = histogram_vector_size (kind, bins)
+    total = ny * nx * q.shape[2]
+    if total < 2**16: dtype = numpy.uint16
+    elif total < 2**32: dtype = numpy.uint32
+    else: dtype = numpy.uint64
+
+    # Working down the image a row of step-by-step cells at a time, count
+    # the pixels of each bin in each cell (the extra bin collects values
+    # outside the limits), accumulate them along the row, and add them to
+    # the totals of the row above.
+    gy = (ny + step - 1) // step
+    gx = (nx + step - 1) // step
+    cx = (numpy.arange (nx) // step)[numpy.newaxis,:,numpy.newaxis]
+    data = numpy.zeros ((gy+1, gx+1, nb), dtype=dtype)
+    for r in xrange (0, gy):
+        cells = cx * (nb + 1) + q[r*step:(r+1)*step]
+        counts = numpy.bincount (cells.ravel(), minlength=gx*(nb+1))
+        counts = counts.reshape (gx, nb+1)[:,:nb]
+        data[r+1,1:] = data[r,1:] + counts.cumsum (axis=0).astype (dtype)
+    return {'data': data, 'kind': kind, 'bins': bins, 'limits': limits,
+            'step': step, 'ny': ny, 'nx': nx}
+
+#-------------------------------------------------------------------------------
+def integral_histogram_region (ih, ylo, yhi, xlo, xhi):
+    """
+    Return the histogram of a rectangular region of an image from its
+    integral histogram, as a float32 vector equal to what histogram_vector
+    (or, for a 'flat' histogram with other limits, histogram) would give
+    for the region.  The limits of the region may also be arrays, in which
+    case the histograms of all the regions are returned at once, one per
+    row, which is an efficient way of searching with a sliding window.
+
+    Arguments:
+     ih  the integral histogram, from integral_histogram
+    ylo  first row of the region
+    yhi  row after the last of the region
+    xlo  first column of the region
+    xhi  column after the last of the region
+
+    The region is im[ylo:yhi,xlo:xhi], clipped to the image.  When the
+    integral histogram was built with a step greater than one, the region
+    is enlarged to the nearest multiples of it.
+    """
+    step = ih['step']
+    gy, gx, nb = ih['data'].shape
+    ylo = numpy.clip (numpy.asarray (ylo) // step, 0, gy - 1)
+    xlo = numpy.clip (numpy.asarray (xlo) // step, 0, gx - 1)
+    yhi = numpy.clip ((numpy.asarray (yhi) + step - 1) // step, 0, gy - 1)
+    xhi = numpy.clip ((numpy.asarray (xhi) + step - 1) // step, 0, gx - 1)
+    yhi = numpy.maximum (yhi, ylo)
+    xhi = numpy.maximum (xhi, xlo)
+    d = ih['data']
+    h = d[yhi,xhi].astype (numpy.int64) - d[ylo,xhi].astype (numpy.int64) \
+        - d[yhi,xlo].astype (numpy.int64) + d[ylo,xlo].astype (numpy.int64)
+    return h.astype (numpy.float32)
+
+#-------------------------------------------------------------------------------
+def ivf_build (data, ncells=None, iterations=10, sample=64, seed=0,
+               chunk=4096):
+    """
+    Build an inverted-file (IVF) index for approximate nearest-neighbour
+    searches of a gallery of histogram vectors, such as the data of an
+    index from index_load, returning it as a dictionary.
+
+    The vectors are centred and normalized (see normalize_histograms) and
+    partitioned into 'ncells' cells by k-means clustering of a random
+    sample of them, after which every vector is assigned to the cell whose
+    centroid it correlates with best.  ivf_search then compares a probe
+    with the vectors of only the few cells whose centroids it correlates
+    with best, which is much quicker than scanning the whole gallery but
+    may miss some good matches; ivf_recall measures how many.  The
+    dictionary contains the unit-length centroids ('centroids'), the gallery
+    row numbers in cell order ('order'), the position in 'order' at which
+    each cell starts ('offsets'), and the number of vectors indexed
+    ('count').  An empty gallery yields an index with no cells.
+
+    Arguments:
+          data  array of histogram vectors, one per row
+        ncells  number of cells (default: the square root of the number
+                of vectors)
+    iterations  number of iterations of k-means clustering (default: 10)
+        sample  number of vectors per cell used for clustering (default: 64)
+          seed  seed for the random number generator (default: 0)
+         chunk  number of rows of data processed at once (default: 4096)
+    """
+    n = len (data)
+    if n == 0:
+        return {'centroids': numpy.zeros ((0, data.shape[1])),
+                'order': numpy.zeros (0, dtype=int),
+                'offsets': numpy.zeros (1, dtype=int), 'count': 0}
+    if ncells is None: ncells = int (math.sqrt (n))
+    ncells = numpy.clip (ncells, 1, n)
+    rng = numpy.random.RandomState (seed)
+
+    # Cluster a sample of the vectors, re-seeding any empty cell from a
+    # randomly-chosen vector.
+    ns = numpy.clip (sample * ncells, ncells, n)
+    rows = numpy.sort (rng.choice (n, ns, replace=False))
+    vecs = normalize_histograms (data[rows])
+    centroids = vecs[rng.choice (ns, ncells, replace=False)]
+    for it in xrange (0, iterations):
+        cells = numpy.argmax (numpy.dot (vecs, centroids.T), axis=1)
+        centroids = numpy.zeros (centroids.shape)
+        numpy.add.at (centroids, cells, vecs)
+        empty = numpy.bincount (cells, minlength=ncells) == 0
+        centroids[empty] = vecs[rng.randint (0, ns, empty.sum())]
+        centroids = normalize_histograms (centroids)
+
+    # Assign every vector to a cell and sort the row numbers by cell.
+    cells = numpy.zeros (n, dtype=int)
+    for lo in xrange (0, n, chunk):
+        block = normalize_histograms (data[lo:lo+chunk])
+        cells[lo:lo+chunk] = numpy.argmax (numpy.dot (block, centroids.T),
+                                           axis=1)
+    order = numpy.argsort (cells, kind='mergesort')
+    offsets = numpy.zeros (ncells+1, dtype=int)
+    offsets[1:] = numpy.cumsum (numpy.bincount (cells, minlength=ncells))
+    return {'centroids': centroids, 'order': order, 'offsets': offsets,
+            'count': n}
+
+#-------------------------------------------------------------------------------
+def ivf_load (name):
+    """
+    Load an IVF index saved by ivf_save, raising ValueError if the index
+    from which it was built has changed since.
+
+    Arguments:
+    name  name of the index (see index_build)
+    """
+    manfn, datfn = index_names (name)
+    root, ext = os.path.splitext (manfn)
+    f = open (root + '.ivf', 'rb')
+    saved = numpy.load (f)
+    ivf = {}
+    for k in saved.files: ivf[k] = saved[k]
+    f.close ()
+    if str (ivf.get ('fingerprint', '')) != index_fingerprint (name):
+        raise ValueError, 'IVF index is out of date; rebuild it'
+    ivf['count'] = int (ivf['count'])
+    ivf['fingerprint'] = str (ivf['fingerprint'])
+    return ivf
+
+#-------------------------------------------------------------------------------
+def ivf_recall (ivf, data, k=10, nprobe=8, nqueries=100, seed=0):
+    """
+    Measure how well IVF searches agree with an exhaustive scan, returning
+    the recall at k (the proportion of the k best matches found by the scan
+    that the IVF search also finds), and the mean times taken per query by
+    the scan and by the IVF search, in seconds.  The queries are vectors
+    picked at random from the gallery itself, each being excluded from its
+    own matches.
+
+    Arguments:
+         ivf  the IVF index, from ivf_build or ivf_load
+        data  array of histogram vectors from which ivf was built
+           k  number of best matches compared (default: 10)
+      nprobe  number of cells examined by each IVF search (default: 8)
+    nqueries  number of queries made (default: 100)
+        seed  seed for the random number generator (default: 0)
+    """
+    import time
+    n = len (data)
+    rng = numpy.random.RandomState (seed)
+    queries = rng.choice (n, numpy.clip (nqueries, 1, n), replace=False)
+    found = 0
+    tscan = tivf = 0.0
+    for q in queries:
+        t0 = time.time ()
+        scores = correlation_scores (data[q], data)
+        scores[q] = -1.0
+        exact = top_matches (scores, k)
+        t1 = time.time ()
+        rows, scores = ivf_search (ivf, data[q], data, k+1, nprobe=nprobe)
+        t2 = time.time ()
+        approx = dict.fromkeys (rows[rows != q][:k])
+        found += len ([i for i in exact if i in approx])
+        tscan += t1 - t0
+        tivf += t2 - t1
+    nq = len (queries)
+    return found / (nq * k), tscan / nq, tivf / nq
+
+#-------------------------------------------------------------------------------
+def ivf_save (ivf, name):
+    """
+    Save an IVF index alongside the index from which it was built, in a
+    file with the same root and an extension of '.ivf'.  The index's
+    fingerprint (see index_fingerprint) is saved with it, so that ivf_load
+    can tell when the index has changed.
+
+    Arguments:
+     ivf  the IVF index, from ivf_build
+    name  name of the index (see index_build)
+    """
+    manfn, datfn = index_names (name)
+    root, ext = os.path.splitext (manfn)
+    ivf = ivf.copy ()
+    ivf['fingerprint'] = index_fingerprint (name)
+    f = open (root + '.ivf.tmp', 'wb')
+    numpy.savez (f, **ivf)
+    f.close ()
+    os.rename (root + '.ivf.tmp', root + '.ivf')
+
+#-------------------------------------------------------------------------------
+def ivf_search (ivf, probe, data, k, nprobe=8):
+    """
+    Search for the vectors in a gallery that best match a probe using an IVF
+    index, returning the row numbers of the (at most) k best, best first,
+    and their absolute correlation coefficients with the probe.
+
+    Arguments:
+       ivf  the IVF index, from ivf_build or ivf_load
+     probe  the vector to be matched
+      data  array of histogram vectors from which ivf was built
+         k  number of matches to be returned
+    nprobe  number of cells examined (default: 8); examining more cells
+            finds more of the best matches at the cost of speed
+    """
+    if ivf['count'] != len (data):
+        raise ValueError, 'IVF index does not match the data; rebuild it'
+    p = normalize_histograms (probe)[0]
+    cells = top_matches (numpy.dot (ivf['centroids'], p), nprobe)
+    order = ivf['order']
+    offsets = ivf['offsets']
+    rows = numpy.concatenate ([order[offsets[c]:offsets[c+1]] for c in cells]
+                              + [numpy.zeros (0, dtype=int)])
+    rows.sort ()
+    scores = numpy.abs (numpy.dot (normalize_histograms (data[rows]), p))
+    best = top_matches (scores, k)
+    return rows[best], scores[best]
+
 #-------------------------------------------------------------------------------
 def label_regions (im, con8=False):
     """
@@ -2788,6 +4143,24 @@ def mse (im1, im2):
     ny, nx, nc = sizes (im1)
     return ssd (im1, im2) / float(ny * nx * nc)
 
+#-------------------------------------------------------------------------------
+def normalize_histograms (h):
+    """
+    Centre each histogram vector on zero and scale it to unit length,
+    returning the result as a float64 array with one vector per row, so
+    that the correlation coefficient of two histograms becomes their inner
+    product.  Vectors with no variation are returned as all zeros.
+
+    Arguments:
+    h  a single histogram vector or an array of them, one per row
+    """
+    h = numpy.array (h, dtype=numpy.float64, ndmin=2)
+    h -= h.mean (axis=1)[:,numpy.newaxis]
+    norms = numpy.sqrt ((h * h).sum (axis=1))
+    norms[norms <= 0.0] = 1.0
+    h /= norms[:,numpy.newaxis]
+    return h
+
 #-------------------------------------------------------------------------------
 def output (im, fn):
     """
@@ -3034,6 +4407,163 @@ def print_positions (pos, format="%4d %4d", intro=None, fd=sys.stdout):
     for y, x in pos:
         print >>fd, format % (y, x)
 
+#-------------------------------------------------------------------------------
+def profile_begin ():
+    """
+    Start collecting the times taken by the stages of reading and comparing
+    images (see profile_stage), discarding any collected earlier.  Until
+    this is called, nothing is collected and the stages are slowed by no
+    more than a test of the variable 'profiling'.
+    """
+    global profiling
+    profiling = {'records': [], 'start': profile_mark ()}
+
+#-------------------------------------------------------------------------------
+def profile_call (func, args):
+    """
+    Call a function while collecting the times of its stages, returning its
+    result and the stages' records, for profile_result to unpack.  This is
+    used to profile the work done by worker processes.
+
+    Arguments:
+    func  the function to be called
+    args  tuple of the arguments to be passed to it
+    """
+    profile_begin ()
+    result = func (*args)
+    return result, profiling['records']
+
+#-------------------------------------------------------------------------------
+def profile_end (nimages=None):
+    """
+    Stop collecting the times of stages and return a report on them as a
+    dictionary, suitable for writing out as JSON.
+
+    The report contains the elapsed wall-clock ('wall') and CPU ('cpu')
+    times in seconds since profile_begin, the number of images read
+    ('images') and the rate at which they were processed
+    ('images_per_second'), and the peak resident memory of the process in
+    megabytes ('peak_rss_mb').  For each stage ('stages'), it gives the
+    number of times it was carried out ('count'), its total wall-clock and
+    CPU times ('wall', 'cpu'), the 50th, 95th and 99th percentiles of its
+    wall-clock time ('p50', 'p95', 'p99') and the peak memory of the process
+    when it finished ('peak_rss_mb').  Finally, it lists each image in turn
+    ('per_image'), giving for each of its stages the wall-clock and CPU
+    times ('wall', 'cpu') and the peak memory of the process when the stage
+    finished ('peak_rss_mb').  The times of stages carried out by worker
+    processes are included in the totals of the stages but not in the
+    elapsed times, which is why the CPU times of the stages can add up to
+    more than the elapsed CPU time.
+
+    Arguments:
+    nimages  the number of images processed (default: the number of images
+             whose stages were recorded)
+    """
+    global profiling
+    p = profiling
+    profiling = None
+    if p is None: return None
+    wall, cpu, rss = profile_mark ()
+    wall -= p['start'][0]
+    cpu -= p['start'][1]
+    stages = {}
+    per_image = []
+    for stage, what, w, c, r in p['records']:
+        if stage is None:
+            if what is None: what = 'image %d' % len (per_image)
+            per_image.append ({'image': what})
+            continue
+        if stage not in stages: stages[stage] = []
+        stages[stage].append ((w, c, r))
+        if what and len (per_image) > 0:
+            t = per_image[-1].setdefault (stage, {'wall': 0.0, 'cpu': 0.0,
+                                                  'peak_rss_mb': 0.0})
+            t['wall'] += w
+            t['cpu'] += c
+            if r / 1024.0 > t['peak_rss_mb']: t['peak_rss_mb'] = r / 1024.0
+    report = {'stages': {}, 'per_image': per_image}
+    for stage in stages:
+        w = numpy.array ([t[0] for t in stages[stage]])
+        p50, p95, p99 = numpy.percentile (w, [50, 95, 99])
+        report['stages'][stage] = {
+            'count': len (w), 'wall': float (w.sum()),
+            'cpu': float (numpy.sum ([t[1] for t in stages[stage]])),
+            'p50': float (p50), 'p95': float (p95), 'p99': float (p99),
+            'peak_rss_mb': numpy.max ([t[2] for t in stages[stage]]) / 1024.0}
+    if nimages is None: nimages = len (per_image)
+    report['images'] = nimages
+    report['wall'] = wall
+    report['cpu'] = cpu
+    report['peak_rss_mb'] = rss / 1024.0
+    if wall > 0.0: report['images_per_second'] = nimages / wall
+    else: report['images_per_second'] = 0.0
+    return report
+
+#-------------------------------------------------------------------------------
+def profile_image (what):
+    """
+    Note that the stages recorded from now on are for a new image, until
+    this is called again.
+
+    Arguments:
+    what  the name of the image's file, or a file object holding it
+    """
+    if not isinstance (what, str): what = None
+    profiling['records'].append ((None, what, 0.0, 0.0, 0))
+
+#-------------------------------------------------------------------------------
+def profile_mark ():
+    """
+    Return the current wall-clock and CPU times, in seconds, and the peak
+    resident memory of the process, in kilobytes (zero where this cannot
+    be found), for timing a stage with profile_stage.
+    """
+    import time
+    try:
+        import resource
+        r = resource.getrusage (resource.RUSAGE_SELF)
+        return time.time (), r.ru_utime + r.ru_stime, r.ru_maxrss
+    except ImportError:
+        return time.time (), time.clock (), 0
+
+#-------------------------------------------------------------------------------
+def profile_result (result):
+    """
+    Unpack the result of a function called by profile_call, recording the
+    times of its stages if profiling and returning what the function
+    returned.
+
+    Arguments:
+    result  what profile_call returned, or just the function's result when
+            not profiling
+    """
+    if profiling is None: return result
+    result, records = result
+    profiling['records'] += records
+    return result
+
+#-------------------------------------------------------------------------------
+def profile_stage (stage, mark, image=True):
+    """
+    Record the time taken by a stage of processing, returning a new mark
+    from which the next stage can be timed.  Stages are recorded only
+    while profiling, so calls are normally written as
+
+        if profiling is not None: mark = profile_mark ()
+        ...
+        if profiling is not None: mark = profile_stage ('stage', mark)
+
+    Arguments:
+    stage  the name of the stage (e.g., 'decode' or 'histogram')
+     mark  the mark, from profile_mark or profile_stage, when it started
+    image  if True, the stage belongs to the image last noted by
+           profile_image (default: True)
+    """
+    now = profile_mark ()
+    profiling['records'].append ((stage, image, now[0] - mark[0],
+                                  now[1] - mark[1], now[2]))
+    return now
+
 #-------------------------------------------------------------------------------
 def radial_profile (im, y0=None, x0=None, rlo=0.0, rhi=None, alo=-math.pi,
                      ahi=math.pi):
@@ -3648,6 +5178,29 @@ def thong (im, scale=64.0, offset=128.0):
                 v = scale * math.cos (fac * (2*r - rsqd/rad - rad2)) + offset
                 im[y,x,:] = v
 
+#-------------------------------------------------------------------------------
+def top_matches (scores, k):
+    """
+    Return the indices of the k highest scores, highest first.
+
+    The k highest are picked out with a partial selection, which takes time
+    proportional to the number of scores, and only they are then sorted, so
+    this is much quicker than sorting all the scores when k is small.
+
+    Arguments:
+    scores  the scores to be examined (e.g., from correlation_scores)
+         k  the number of indices to be returned
+    """
+    scores = numpy.asarray (scores)
+    n = len (scores)
+    if k <= 0 or n == 0: return numpy.zeros (0, dtype=int)
+    if k == 1: return numpy.array ([numpy.argmax (scores)])
+    if k < n:
+        best = numpy.argpartition (-scores, k-1)[:k]
+    else:
+        best = numpy.arange (n)
+    return best[numpy.argsort (-scores[best], kind='mergesort')]
+
 #-------------------------------------------------------------------------------
 def transpose (im):
     """